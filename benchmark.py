@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import argparse
+import textwrap
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import os
+import json
+import logging
+import BaseHTTPServer
+import SocketServer
+
+import import_video
+
+DESCRIPTION = \
+"""
+Measures the throughput of the importer. A synthetic directory tree of fake .mp4 files (named to match the
+importer's default --regex) is generated, every discovery stage (walking, hashing, duration probing, storage
+writes) is timed on its own, and then the whole import is run against a local HTTP sink standing in for the
+segmentation service, through the benchmark_hooks.py hooks-module. The sink can simulate latency and failures.
+"""
+
+EXAMPLES = \
+"""
+The following example benchmarks 200 files of 20 MB each, with 50 ms of latency and 5% of failed requests at
+the sink, uploading through 4 workers. Arguments after -- are passed on to the importer.
+
+python benchmark.py --files 200 --size 20 --latency 50 --failure_rate 0.05 -- --upload_workers 4
+"""
+
+HOOKS_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_hooks.py')
+BLOCK_SIZE = 1024 * 1024
+
+
+def mp4_header(index, duration):
+    """ the ftyp and moov/mvhd boxes of a playable-looking mp4, with `duration` seconds at a 1000 Hz timescale """
+    ftyp = struct.pack('>I4s4sI8s', 24, 'ftyp', 'isom', 0x200, 'isommp41')
+    mvhd = struct.pack('>I4sIIIII', 108, 'mvhd', 0, index, index, 1000, int(duration * 1000))
+    mvhd += struct.pack('>IH10x', 0x10000, 0x100)
+    mvhd += struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    mvhd += struct.pack('>24xI', 2)
+    moov = struct.pack('>I4s', 8 + len(mvhd), 'moov') + mvhd
+    return ftyp + moov
+
+
+def generate_corpus(folder, files, size, cameras, duration=60):
+    """ writes `files` fake videos of `size` bytes each, spread over `cameras` cameras and sub-folders """
+    block = os.urandom(BLOCK_SIZE)
+    start = int(time.time()) - files * duration
+    total = 0
+    for index in range(files):
+        camera = 'CAMERA%02i' % (index % cameras)
+        path = os.path.join(folder, camera)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        filename = os.path.join(path, '%s-bench-%i.mp4' % (camera, start + index * duration))
+        header = mp4_header(index, duration)
+        remaining = max(0, size - len(header) - 8)
+        with open(filename, 'wb') as myfile:
+            myfile.write(header)
+            myfile.write(struct.pack('>I4s', 8 + remaining, 'mdat'))
+            while remaining:
+                chunk = block[:min(remaining, BLOCK_SIZE)]
+                myfile.write(chunk)
+                remaining -= len(chunk)
+        total += os.path.getsize(filename)
+    return total
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class SinkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ reads and discards uploads, after `latency` seconds, failing `failure_rate` of them with a 503 """
+
+    protocol_version = 'HTTP/1.1'
+
+    def handle_upload(self):
+        length = int(self.headers.get('Content-Length', 0))
+        while length:
+            length -= len(self.rfile.read(min(length, BLOCK_SIZE)))
+        time.sleep(self.server.latency)
+        failed = random.random() < self.server.failure_rate
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.failures += failed
+        self.send_response(503 if failed else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_POST = do_PUT = handle_upload
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_sink(latency=0.0, failure_rate=0.0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SinkHandler)
+    server.latency = latency
+    server.failure_rate = failure_rate
+    server.lock = threading.Lock()
+    server.requests = server.failures = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def timed(name, files, nbytes, func):
+    started = time.time()
+    func()
+    seconds = max(time.time() - started, 1e-6)
+    return dict(stage=name, files=files, mb=nbytes / 1e6, seconds=seconds,
+                files_per_sec=files / seconds, mb_per_sec=nbytes / 1e6 / seconds)
+
+
+def run_import(folder, storage, port, importer_args):
+    importer = import_video.GenericImporter()
+    importer.init_args([folder, HOOKS_MODULE, '-q', '--host', '127.0.0.1', '--port', str(port), '-s', storage,
+                        '--camera_settle_time', '0', '--retry_backoff', '0.1'] + importer_args)
+    try:
+        importer.upload_folder(folder)
+    except SystemExit:
+        pass  # no new files found
+
+
+def benchmark(args, importer_args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='import_video_bench_')
+    folder = os.path.join(workdir, 'videos')
+    storage = os.path.join(workdir, 'bench.sqlite')
+    try:
+        logging.info("generating %i files of %.1f MB in %s", args.files, args.size, folder)
+        nbytes = generate_corpus(folder, args.files, int(args.size * 1e6), args.cameras)
+        importer = import_video.GenericImporter()
+        filenames = []
+        results = [timed('walk', args.files, 0, lambda: filenames.extend(importer.folder_walker(folder)))]
+        results.append(timed('hash (full)', len(filenames), nbytes,
+                             lambda: [import_video.hash_file(filename) for filename in filenames]))
+        results.append(timed('hash (sampled)', len(filenames), nbytes,
+                             lambda: [import_video.sample_file(filename) for filename in filenames]))
+        results.append(timed('probe', len(filenames), nbytes,
+                             lambda: [import_video.get_duration(filename) for filename in filenames]))
+
+        def write_records():
+            db = import_video.StateStore(os.path.join(workdir, 'records.sqlite'))
+            for index, filename in enumerate(filenames):
+                db['%040x' % index] = dict(filename=filename, camera='CAMERA', uploaded_on=None, job_id=None)
+                db.sync()
+            db.close()
+        results.append(timed('storage', len(filenames), 0, write_records))
+
+        sink = start_sink(args.latency / 1000.0, args.failure_rate)
+        results.append(timed('import', len(filenames), nbytes,
+                             lambda: run_import(folder, storage, sink.server_address[1], importer_args)))
+        results.append(timed('re-run', len(filenames), 0,
+                             lambda: run_import(folder, storage, sink.server_address[1], importer_args)))
+        sink.shutdown()
+        return results, sink
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent(DESCRIPTION), epilog=EXAMPLES)
+    parser.add_argument('-n', '--files', type=int, default=100, help='number of synthetic videos (default: 100)')
+    parser.add_argument('--size', type=float, default=10, help='size of each synthetic video in MB (default: 10)')
+    parser.add_argument('--cameras', type=int, default=4, help='number of cameras the videos are spread over (default: 4)')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds the sink waits before answering (default: 0)')
+    parser.add_argument('--failure_rate', type=float, default=0,
+                        help='fraction of uploads the sink rejects, to exercise retries (default: 0)')
+    parser.add_argument('--workdir', default=None, help='folder for the corpus and storage db (default: a temporary folder)')
+    parser.add_argument('--keep', action='store_true', default=False, help='keep the temporary folder after the run')
+    parser.add_argument('--json', action='store_true', default=False, help='print the results as json lines')
+    args, importer_args = parser.parse_known_args()
+    importer_args = [arg for arg in importer_args if arg != '--']
+
+    results, sink = benchmark(args, importer_args)
+    if args.json:
+        for result in results:
+            print json.dumps(result)
+        return
+    print '%-16s %7s %9s %9s %10s %9s' % ('STAGE', 'FILES', 'MB', 'SECONDS', 'FILES/SEC', 'MB/SEC')
+    for result in results:
+        print '%(stage)-16s %(files)7i %(mb)9.1f %(seconds)9.2f %(files_per_sec)10.1f %(mb_per_sec)9.1f' % result
+    print 'the sink answered %i upload requests and rejected %i of them on purpose' % (sink.requests, sink.failures)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+import requests
+
+"""
+A stand-in hooks-module used by benchmark.py. Instead of talking to a real segmentation service it streams
+every video (or every chunk of a video) to the local HTTP sink started by the benchmark, at the --host and
+--port the importer is given. The sink decides how slow and how unreliable the "service" is.
+"""
+
+session = requests.Session()
+
+
+def set_hook_data(data):
+    pass
+
+
+def register_camera(camera_name, host=None, port=None):
+    return {'camera_id': camera_name, 'name': camera_name}
+
+
+def post_video_content(camera_name, camera_id, filepath, timestamp, location=None, host=None, port=None, session=session):
+    url = 'http://%s:%s/upload/%s' % (host, port, camera_id)
+    with open(filepath, 'rb') as myfile:
+        res = session.post(url, data=myfile, headers={'X-Timestamp': timestamp})
+    return res.status_code == 200
+
+
+def post_video_chunk(camera_name, camera_id, filepath, timestamp, upload_id, offset, data, total_size,
+                     location=None, host=None, port=None, session=session):
+    url = 'http://%s:%s/upload/%s/%s' % (host, port, camera_id, upload_id)
+    headers = {'Content-Range': 'bytes %i-%i/%i' % (offset, offset + len(data) - 1, total_size)}
+    res = session.put(url, data=data, headers=headers)
+    return res.status_code == 200
@@ -5,8 +5,12 @@ import os
 
 """
 This file defines the required template for a given hooks-module to be used with the import_video.py 
-script. The `register_camera` and `post_video_content` functions are required, but the `set_hook_data`
-is optional and will only be called if it exists.
+script. The `register_camera` and `post_video_content` functions are required, but the `set_hook_data`,
+`post_video_chunk` and `check_video_uploaded` functions are optional and will only be called if they exist.
+
+`register_camera` (and the optional `register_jobs`) run on background threads, so the importer keeps
+discovering and uploading files while the service answers. `register_camera`, `post_video_content` and
+`post_video_chunk` are handed the importer's pooled requests.Session if they take a `session` argument.
 """
 
 def set_hook_data(data):
@@ -20,12 +24,13 @@ def set_hook_data(data):
     pass
 
 
-def register_camera(camera_name, host=None, port=None):
+def register_camera(camera_name, host=None, port=None, session=None):
     """
     arguments:
         camera_name   - the name of the camera (as parsed from the filename)
         host          - the URI/IP address of the segmenter being used
         port          - the port to access the webserver of the segmenter
+        session(opt)  - a pooled requests.Session shared with the uploads, only passed if this argument exists
     returns: this function returns a dictionary describing the new camera
              NOTE: the response from the register_camera function must include a field named camera_id,
              which is the unique ID assigned by the service used to register this camera_name.
@@ -38,7 +43,7 @@ def register_camera(camera_name, host=None, port=None):
     pass
 
 
-def post_video_content(host, port, camera_name, camera_id, filepath, timestamp, location=None):
+def post_video_content(host, port, camera_name, camera_id, filepath, timestamp, location=None, session=None):
     """
     arguments:
         host        - the url of the segmenter
@@ -49,6 +54,7 @@ def post_video_content(host, port, camera_name, camera_id, filepath, timestamp,
         timestamp   - the starting timestamp of the video file
         location(opt) - a string of JSON describing the location of the camera
                         Example {"location": {"lat": 7.367598, "lng":134.706975}, "accuracy":5.0}
+        session(opt)  - a pooled requests.Session shared by all upload workers, only passed if this argument exists
     returns: true/false based on success
 
     description: This function is called each time a new video file is found for a specific camera, so 
@@ -56,3 +62,54 @@ def post_video_content(host, port, camera_name, camera_id, filepath, timestamp,
                  For example, when using Camio, the HTTP POST to the segmenter resides here.
     """
     pass
+
+
+def post_video_chunk(camera_name, camera_id, filepath, timestamp, upload_id, offset, data, total_size,
+                     location=None, host=None, port=None, session=None):
+    """
+    (optional)
+    arguments:
+        camera_name - the parsed name of the camera
+        camera_id   - the ID of the camera as returned from the service
+        filepath    - full path to the video file being uploaded
+        timestamp   - the starting timestamp of the video file
+        upload_id   - a key that identifies this video across runs of the importer (the content hash)
+        offset      - the byte offset of `data` within the video file
+        data        - the bytes of this chunk (empty only for an empty video file)
+        total_size  - the size of the whole video file in bytes
+        location(opt) - same as for post_video_content
+        host, port  - same as for post_video_content
+        session     - a pooled requests.Session shared by all upload workers
+    returns: true/false based on whether the service acknowledged the chunk
+
+    description: When the importer is run with --chunk_size and this function exists, videos are sent as
+                 a series of chunks instead of through post_video_content. The offset of every acknowledged
+                 chunk is kept in the importer's storage db, so an interrupted upload resumes from the last
+                 acknowledged chunk (on retry or on the next run) rather than from the start of the file.
+                 The upload is complete once the chunk ending at total_size has been acknowledged.
+    """
+    pass
+
+
+def check_video_uploaded(camera_name, camera_id, filepath, timestamp, upload_id, total_size,
+                         host=None, port=None, session=None):
+    """
+    (optional)
+    arguments:
+        camera_name - the parsed name of the camera
+        camera_id   - the ID of the camera as returned from the service (None if it is no longer cached)
+        filepath    - full path to the video file
+        timestamp   - the starting timestamp of the video file
+        upload_id   - a key that identifies this video across runs of the importer (the content hash)
+        total_size  - the size of the whole video file in bytes
+        host, port  - same as for post_video_content
+        session(opt)  - a pooled requests.Session, only passed if this argument exists
+    returns: true if the service already has the whole video, false otherwise
+
+    description: The importer journals every upload in its storage db. When a run is interrupted (a crash,
+                 a kill, a power cut) while a video is being uploaded, the next run calls this function to ask
+                 whether the video made it to the service before the interruption. If it did, the video is
+                 recorded as uploaded instead of being uploaded again. Without this function such videos are
+                 uploaded again (chunked uploads resume from their last acknowledged chunk).
+    """
+    pass
@@ -1,13 +1,28 @@
 import argparse
 import time
+import threading
+import multiprocessing
+import collections
+import itertools
+import functools
+import contextlib
+import cProfile
+import Queue
 import shelve
+import whichdb
+import sqlite3
+import cPickle as pickle
 import textwrap
 import imp
+import inspect
 import json
 import psutil
 import os
 import sys
+import signal
 import hashlib
+import mmap
+import struct
 import datetime
 import csv
 import StringIO
@@ -25,6 +40,18 @@ try:
 except:
     HAVE_HACHOIR = False
 
+try:
+    import pyinotify
+    HAVE_PYINOTIFY = True
+except:
+    HAVE_PYINOTIFY = False
+
+try:
+    # the scandir backport walks without a stat per directory entry
+    from scandir import walk as walk_tree
+except:
+    walk_tree = os.walk
+
 DESCRIPTION = \
 """
 This script traverses a directory of video files, parses the file names for metadata
@@ -47,20 +74,876 @@ logging.getLogger('requests').setLevel(logging.WARNING)
 
 re_notascii = re.compile('\W')
 
+# large reads keep hashing bound by the disk rather than by python call overhead
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def hash_file(filename, block_size=HASH_BLOCK_SIZE):
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as myfile:
+        for chunk in iter(lambda: myfile.read(block_size), ''):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+# size of each of the head, middle and tail blocks read by the sampled fingerprint
+SAMPLE_BLOCK_SIZE = 4 * 1024 * 1024
+
+def sample_file(filename, block_size=SAMPLE_BLOCK_SIZE):
+    """
+    returns (key, complete). files of up to three blocks are hashed in full, so their key is the same
+    SHA-1 that hash_file gives (complete=True). larger files are keyed by the SHA-1 of their size and
+    of the blocks at their head, middle and tail, read through a memory map (complete=False).
+    """
+    size = os.path.getsize(filename)
+    if size <= 3 * block_size:
+        return hash_file(filename), True
+    hasher = hashlib.sha1('sampled:%i:' % size)
+    with open(filename, 'rb') as myfile:
+        mapped = mmap.mmap(myfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            middle = (size - block_size) // 2
+            for start in (0, middle, size - block_size):
+                hasher.update(mapped[start:start + block_size])
+        finally:
+            mapped.close()
+    return hasher.hexdigest(), False
+
+def hash_task(args):
+    # runs in a discovery worker process, so it must stay a picklable module-level function. errors are
+    # returned rather than raised, a task that raises never reaches the apply_async callback
+    filename, fingerprint = args
+    try:
+        if fingerprint == 'sampled':
+            return (filename,) + sample_file(filename) + (None,)
+        return filename, hash_file(filename), True, None
+    except Exception as e:
+        return filename, None, False, '%s: %s' % (type(e).__name__, e)
+
+def read_box_header(myfile):
+    """ returns (type, payload size) of the mp4 box at the current position, or (None, 0) at the end of the file """
+    header = myfile.read(8)
+    if len(header) < 8:
+        return None, 0
+    size, box_type = struct.unpack('>I4s', header)
+    if size == 1:
+        size = struct.unpack('>Q', myfile.read(8))[0] - 16
+    elif size == 0:
+        size = os.fstat(myfile.fileno()).st_size - myfile.tell()
+    else:
+        size -= 8
+    return box_type, size
+
+def find_box(myfile, box_type, end):
+    """ seeks to the payload of the first `box_type` box before `end` and returns its size, skipping other boxes """
+    while myfile.tell() < end:
+        found, size = read_box_header(myfile)
+        if found is None or size < 0:
+            return None
+        if found == box_type:
+            return size
+        myfile.seek(size, os.SEEK_CUR)
+    return None
+
+def get_mp4_duration(filename):
+    """
+    reads the duration from the moov/mvhd box of an mp4 file with a few small reads, seeking over
+    everything else (including an mdat box placed before the moov box). returns None if there is none.
+    """
+    with open(filename, 'rb') as myfile:
+        size = os.fstat(myfile.fileno()).st_size
+        moov_size = find_box(myfile, 'moov', size)
+        if moov_size is None:
+            return None
+        if find_box(myfile, 'mvhd', myfile.tell() + moov_size) is None:
+            return None
+        version = ord(myfile.read(4)[0])
+        if version == 1:
+            timescale, duration = struct.unpack('>16xIQ', myfile.read(28))
+        else:
+            timescale, duration = struct.unpack('>8xII', myfile.read(16))
+        if not timescale:
+            return None
+        return float(duration) / timescale
+
 def get_duration(filename):
     duration = None
+    try:
+        duration = get_mp4_duration(filename)
+    except:
+        logging.debug("unable to read the mvhd box of %s, falling back to hachoir", filename)
+    if duration is not None:
+        return duration
     try:
         if HAVE_HACHOIR:
             filename = unicode(filename, "utf-8")
             parser = createParser(filename)
             metadata = extractMetadata(parser, quality=1.0)
             duration = metadata.getValues('duration')[0].total_seconds()
+        else:
+            logging.warn("unable to find the duration of %s (no mvhd box and hachoir is not installed)", filename)
         return duration
     except:
         logging.error("error while getting duration metadata from movie (%s)", filename)
         logging.error(traceback.format_exc())
         return None
 
+def timed_task(args):
+    # wraps work sent to the discovery pool, so the time spent in the worker process can be accounted for
+    func, func_args = args
+    started = time.time()
+    return func(*func_args), time.time() - started
+
+def ignore_sigint():
+    # initializer of the discovery workers. ctrl-c reaches the whole process group, and a worker killed while
+    # it holds the pool's task queue lock would leave Pool.terminate() waiting forever, so only the importer handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class StateStore(object):
+    """
+    sqlite (WAL mode) storage db of file records keyed by content hash. it behaves like the shelve
+    it replaces - `db[key] = params`, `key in db`, `db.sync()` - so hook modules that are handed the
+    db keep working. records are pickled like shelve did, with the fields worth querying on copied
+    into indexed columns. `sync` only commits every `batch_size` writes (or `batch_interval` seconds),
+    `commit` forces it. a single connection is shared by all threads, guarded by `lock`.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            hash TEXT PRIMARY KEY,
+            filename TEXT,
+            camera TEXT,
+            uploaded_on TEXT,
+            job_id TEXT,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS files_filename ON files (filename);
+        CREATE INDEX IF NOT EXISTS files_camera ON files (camera);
+        CREATE INDEX IF NOT EXISTS files_uploaded_on ON files (uploaded_on);
+        CREATE INDEX IF NOT EXISTS files_job_id ON files (job_id);
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            stat_key TEXT PRIMARY KEY,
+            hash TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS samples (
+            stat_key TEXT PRIMARY KEY,
+            hash TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS aliases (
+            hash TEXT PRIMARY KEY,
+            key TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chunks (
+            hash TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            sha1 TEXT NOT NULL,
+            acked_on TEXT,
+            PRIMARY KEY (hash, offset)
+        );
+        CREATE TABLE IF NOT EXISTS durations (
+            hash TEXT PRIMARY KEY,
+            duration REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS cameras (
+            name TEXT NOT NULL,
+            host TEXT NOT NULL,
+            config BLOB NOT NULL,
+            registered_on REAL NOT NULL,
+            PRIMARY KEY (name, host)
+        );
+        CREATE TABLE IF NOT EXISTS journal (
+            hash TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            data BLOB NOT NULL,
+            updated_on REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, filename, batch_size=100, batch_interval=5.0, readonly=False):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.uncommitted = 0
+        self.last_commit = time.time()
+        self.metrics = None
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.text_factory = str
+        if readonly:
+            # an existing db opened for reading only, it is neither migrated nor written to
+            self.conn.execute('PRAGMA query_only=ON')
+            return
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+
+    @locked
+    def __contains__(self, key):
+        return self.conn.execute('SELECT 1 FROM files WHERE hash=?', (key,)).fetchone() is not None
+
+    @locked
+    def __getitem__(self, key):
+        row = self.conn.execute('SELECT data FROM files WHERE hash=?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(str(row[0]))
+
+    @locked
+    def __setitem__(self, key, params):
+        job_id = params.get('job_id')
+        self.conn.execute('INSERT OR REPLACE INTO files (hash, filename, camera, uploaded_on, job_id, data) '
+                          'VALUES (?, ?, ?, ?, ?, ?)',
+                          (key, params.get('filename'), params.get('camera'), params.get('uploaded_on'),
+                           None if job_id is None else str(job_id),
+                           sqlite3.Binary(pickle.dumps(params, pickle.HIGHEST_PROTOCOL))))
+        self.uncommitted += 1
+
+    @locked
+    def __delitem__(self, key):
+        self.conn.execute('DELETE FROM files WHERE hash=?', (key,))
+        self.uncommitted += 1
+
+    @locked
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    @locked
+    def __iter__(self):
+        return iter([key for key, in self.conn.execute('SELECT hash FROM files')])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems(self, where='', args=(), order_by=None, page_size=500):
+        """
+        streams (key, params) pairs, optionally filtered and ordered on the indexed columns. other threads may
+        write and commit meanwhile (which resets open cursors), so the matching keys are read first and the
+        records then a page at a time, each read under `lock`
+        """
+        query = 'SELECT hash FROM files'
+        if where:
+            query += ' WHERE ' + where
+        if order_by:
+            query += ' ORDER BY ' + order_by
+        with self.lock:
+            keys = [key for key, in self.conn.execute(query, args)]
+        for start in range(0, len(keys), page_size):
+            page = keys[start:start + page_size]
+            with self.lock:
+                rows = dict(self.conn.execute('SELECT hash, data FROM files WHERE hash IN (%s)' % ','.join('?' * len(page)), page))
+            for key in page:
+                if key in rows:
+                    yield key, pickle.loads(str(rows[key]))
+
+    @locked
+    def get_fingerprint(self, stat_key):
+        row = self.conn.execute('SELECT hash FROM fingerprints WHERE stat_key=?', (stat_key,)).fetchone()
+        return row and row[0]
+
+    @locked
+    def set_fingerprint(self, stat_key, key):
+        self.conn.execute('INSERT OR REPLACE INTO fingerprints (stat_key, hash) VALUES (?, ?)', (stat_key, key))
+        self.uncommitted += 1
+
+    @locked
+    def get_sample(self, stat_key):
+        row = self.conn.execute('SELECT hash FROM samples WHERE stat_key=?', (stat_key,)).fetchone()
+        return row and row[0]
+
+    @locked
+    def set_sample(self, stat_key, key):
+        self.conn.execute('INSERT OR REPLACE INTO samples (stat_key, hash) VALUES (?, ?)', (stat_key, key))
+        self.uncommitted += 1
+
+    @locked
+    def add_alias(self, full_key, key):
+        """ records the full SHA-1 of a file whose record is keyed by its sampled fingerprint """
+        self.conn.execute('INSERT OR REPLACE INTO aliases (hash, key) VALUES (?, ?)', (full_key, key))
+        self.uncommitted += 1
+
+    @locked
+    def resolve(self, key):
+        """ maps a full SHA-1 to the key of the record it was verified for, if it has no record of its own """
+        if key in self:
+            return key
+        row = self.conn.execute('SELECT key FROM aliases WHERE hash=?', (key,)).fetchone()
+        return row[0] if row else key
+
+    @locked
+    def get_duration(self, key):
+        row = self.conn.execute('SELECT duration FROM durations WHERE hash=?', (key,)).fetchone()
+        return row and row[0]
+
+    @locked
+    def set_duration(self, key, duration):
+        self.conn.execute('INSERT OR REPLACE INTO durations (hash, duration) VALUES (?, ?)', (key, duration))
+        self.uncommitted += 1
+
+    @locked
+    def get_camera(self, name, host, max_age=None):
+        """ returns the cached registration of a camera with a service, if it is less than max_age seconds old """
+        oldest = 0 if max_age is None else time.time() - max_age
+        row = self.conn.execute('SELECT config FROM cameras WHERE name=? AND host=? AND registered_on>?',
+                                (name, host, oldest)).fetchone()
+        return row and pickle.loads(str(row[0]))
+
+    @locked
+    def set_camera(self, name, host, config):
+        self.conn.execute('INSERT OR REPLACE INTO cameras (name, host, config, registered_on) VALUES (?, ?, ?, ?)',
+                          (name, host, sqlite3.Binary(pickle.dumps(config, pickle.HIGHEST_PROTOCOL)), time.time()))
+        self.uncommitted += 1
+
+    @locked
+    def get_meta(self, name):
+        row = self.conn.execute('SELECT value FROM meta WHERE name=?', (name,)).fetchone()
+        return row and row[0]
+
+    @locked
+    def set_meta(self, name, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+        self.uncommitted += 1
+
+    @locked
+    def last_chunk(self, key):
+        """ returns (offset, length, sha1) of the last acknowledged chunk of a resumable upload, if any """
+        return self.conn.execute('SELECT offset, length, sha1 FROM chunks WHERE hash=? ORDER BY offset DESC LIMIT 1',
+                                 (key,)).fetchone()
+
+    @locked
+    def ack_chunk(self, key, offset, length, sha1, acked_on=None):
+        self.conn.execute('INSERT OR REPLACE INTO chunks (hash, offset, length, sha1, acked_on) VALUES (?, ?, ?, ?, ?)',
+                          (key, offset, length, sha1, acked_on))
+        # acknowledged chunks are what a restart resumes from, so they are committed right away
+        self.commit()
+
+    @locked
+    def clear_chunks(self, key):
+        self.conn.execute('DELETE FROM chunks WHERE hash=?', (key,))
+        self.uncommitted += 1
+
+    @locked
+    def journal_file(self, key, state, params):
+        """
+        records that the upload of a file is under way ('uploading') or done with its jobs still to be
+        registered ('uploaded'). like chunk acks, journal entries are committed right away.
+        """
+        self.conn.execute('INSERT OR REPLACE INTO journal (hash, state, data, updated_on) VALUES (?, ?, ?, ?)',
+                          (key, state, sqlite3.Binary(pickle.dumps(params, pickle.HIGHEST_PROTOCOL)), time.time()))
+        self.commit()
+
+    @locked
+    def journaled(self, state):
+        """ returns the params of the files whose journal entry is in `state` """
+        return [pickle.loads(str(data)) for data, in
+                self.conn.execute('SELECT data FROM journal WHERE state=? ORDER BY updated_on', (state,))]
+
+    @locked
+    def clear_journal(self, keys):
+        self.conn.executemany('DELETE FROM journal WHERE hash=?', [(key,) for key in keys])
+        self.uncommitted += 1
+
+    @locked
+    def sync(self):
+        if self.uncommitted >= self.batch_size or time.time() - self.last_commit >= self.batch_interval:
+            self.commit()
+
+    @locked
+    def commit(self):
+        started = time.time()
+        self.conn.commit()
+        if self.metrics:
+            self.metrics.add('storage:commit', time.time() - started)
+        self.uncommitted = 0
+        self.last_commit = time.time()
+
+    @locked
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def migrate_shelve(self, shelve_name):
+        """ one-shot import of a legacy .processes.shelve store (and its file index, if any) """
+        legacy = shelve.open(shelve_name, 'r')
+        try:
+            for key, params in legacy.iteritems():
+                self[key] = params
+        finally:
+            legacy.close()
+        if whichdb.whichdb(shelve_name + '.index'):
+            index = shelve.open(shelve_name + '.index', 'r')
+            try:
+                for stat_key, key in index.iteritems():
+                    self.set_fingerprint(stat_key, key)
+            finally:
+                index.close()
+        self.set_meta('migrated_from', shelve_name)
+        self.commit()
+
+class Metrics(object):
+    """
+    thread-safe accounting of a run: calls, seconds and bytes per stage (e.g. 'hash', 'probe',
+    'hook:post_video_content') and the progress of the uploads. progress is logged every `interval`
+    seconds and, like the final per-stage summary, also written as json lines to `filename` if given.
+    """
+
+    def __init__(self, filename=None, interval=0):
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.started = time.time()
+        self.upload_started = None
+        self.files_scheduled = self.bytes_scheduled = 0
+        self.files_done = self.files_failed = self.bytes_done = 0
+        self.stream = open(filename, 'a') if filename else None
+        self.write(dict(event='start', time=datetime.datetime.now().isoformat(), pid=os.getpid()))
+        self.stopped = threading.Event()
+        self.thread = None
+        if interval > 0:
+            self.thread = threading.Thread(target=self.reporter, args=(interval,))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def add(self, stage, seconds, nbytes=0):
+        with self.lock:
+            calls, total, total_bytes = self.stages.get(stage, (0, 0.0, 0))
+            self.stages[stage] = (calls + 1, total + seconds, total_bytes + nbytes)
+
+    @contextlib.contextmanager
+    def timer(self, stage, nbytes=0):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - started, nbytes)
+
+    def iterate(self, stage, iterable):
+        """ yields from iterable, accounting the time spent waiting for each item to `stage` """
+        iterator = iter(iterable)
+        while True:
+            started = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage, time.time() - started)
+            yield item
+
+    def scheduled(self, params):
+        with self.lock:
+            self.upload_started = self.upload_started or time.time()
+            self.files_scheduled += 1
+            self.bytes_scheduled += params.get('size') or 0
+
+    def uploaded(self, params, success):
+        with self.lock:
+            if success:
+                self.files_done += 1
+                self.bytes_done += params.get('size') or 0
+            else:
+                self.files_failed += 1
+                self.bytes_scheduled -= params.get('size') or 0
+
+    def progress(self):
+        with self.lock:
+            elapsed = time.time() - (self.upload_started or self.started)
+            rate = self.bytes_done / elapsed if elapsed > 0 else 0.0
+            remaining = self.bytes_scheduled - self.bytes_done
+            return dict(event='progress', elapsed=round(time.time() - self.started, 3),
+                        files_done=self.files_done, files_failed=self.files_failed,
+                        files_scheduled=self.files_scheduled, bytes_done=self.bytes_done,
+                        bytes_scheduled=self.bytes_scheduled, bytes_per_sec=round(rate, 1),
+                        eta=round(remaining / rate, 1) if rate else None)
+
+    def write(self, record):
+        if self.stream:
+            with self.lock:
+                self.stream.write(json.dumps(record) + '\n')
+                self.stream.flush()
+
+    def report(self):
+        progress = self.progress()
+        eta = 'unknown' if progress['eta'] is None else str(datetime.timedelta(seconds=int(progress['eta'])))
+        # the eta only covers the files discovered so far
+        logging.info('progress: %i/%i files, %.1f/%.1f MB uploaded, %.2f MB/s, eta %s',
+                     progress['files_done'], progress['files_scheduled'], progress['bytes_done'] / 1e6,
+                     progress['bytes_scheduled'] / 1e6, progress['bytes_per_sec'] / 1e6, eta)
+        self.write(progress)
+
+    def reporter(self, interval):
+        while not self.stopped.wait(interval):
+            self.report()
+
+    def finish(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.report()
+        for stage, (calls, seconds, nbytes) in self.stages.items():
+            logging.info('%-28s %7i calls %10.2fs %10.1f MB', stage, calls, seconds, nbytes / 1e6)
+            self.write(dict(event='stage', stage=stage, calls=calls, seconds=round(seconds, 3), bytes=nbytes))
+        if self.stream:
+            self.stream.close()
+
+class FingerprintVerifier(object):
+    """
+    computes the full SHA-1 of files that were keyed by a sampled fingerprint in a background thread,
+    and upgrades the storage db with it: the full hash is added to the file index and recorded as an
+    alias of the sampled key, so later runs with either fingerprint strategy recognize the file.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, filename, key, stat_key):
+        self.queue.put((filename, key, stat_key))
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            filename, key, stat_key = item
+            try:
+                full_key = hash_file(filename)
+            except:
+                logging.error('error while verifying the fingerprint of %s', filename)
+                logging.error(traceback.format_exc())
+                continue
+            if full_key in self.db:
+                logging.warn('%s was already recorded as %s before it was sampled as %s', filename, full_key, key)
+            self.db.add_alias(full_key, key)
+            self.db.set_fingerprint(stat_key, full_key)
+            logging.debug('verified %s: %s -> %s', filename, key, full_key)
+
+    def finish(self):
+        self.queue.put(None)
+        while self.thread.is_alive():
+            self.thread.join(3600)
+
+class FolderWatcher(object):
+    """
+    iterating over a watcher yields lists of video files that appeared under `paths` after the watcher was
+    created, each one once it has stopped changing for `settle` seconds. `initial` lists the files that were
+    already there and had settled, for the initial import; files still being written are yielded once they
+    settle like new ones. new files are learned about through
+    inotify when pyinotify is installed and `poll` is false, otherwise by re-walking the folders every `interval`
+    seconds (e.g. for network mounts, where inotify does not see remote changes).
+    """
+
+    def __init__(self, paths, walker, extensions=['.mp4'], settle=30.0, interval=10.0, poll=False):
+        self.paths = paths
+        self.walker = walker
+        self.extensions = extensions
+        self.settle = settle
+        self.interval = interval
+        self.events = set()
+        self.candidates = {}
+        self.notifier = None
+        if HAVE_PYINOTIFY and not poll:
+            mask = pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+            watch_manager = pyinotify.WatchManager()
+            watch_manager.add_watch(paths, mask, rec=True, auto_add=True)
+            self.notifier = pyinotify.Notifier(watch_manager, default_proc_fun=self.on_event,
+                                               timeout=int(interval * 1000))
+        elif not poll:
+            logging.warn("pyinotify is not installed, polling %s every %.1fs for new files", ', '.join(paths), interval)
+        self.known = set()
+        self.initial = []
+        cutoff = time.time() - settle
+        for filename in self.walk():
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            if st.st_mtime > cutoff:
+                # still being copied, possibly
+                self.candidates[filename] = (None, None)
+            else:
+                self.known.add(filename)
+                self.initial.append(filename)
+
+    def walk(self):
+        for path in self.paths:
+            for filename in self.walker(path, self.extensions):
+                yield filename
+
+    def on_event(self, event):
+        if event.dir:
+            # files can land in a new directory before its watch is in place
+            self.events.update(self.walker(event.pathname, self.extensions))
+        elif any(event.pathname.endswith(ext) for ext in self.extensions):
+            self.events.add(event.pathname)
+
+    def wait(self):
+        if not self.notifier:
+            time.sleep(self.interval)
+            return self.walk()
+        if self.notifier.check_events():
+            self.notifier.read_events()
+            self.notifier.process_events()
+        events, self.events = self.events, set()
+        return events
+
+    def __iter__(self):
+        while True:
+            for filename in self.wait():
+                if filename not in self.known and filename not in self.candidates:
+                    self.candidates[filename] = (None, None)
+            now = time.time()
+            ready = []
+            for filename, (stat, since) in self.candidates.items():
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    del self.candidates[filename]
+                    continue
+                if (st.st_size, st.st_mtime) != stat:
+                    self.candidates[filename] = ((st.st_size, st.st_mtime), now)
+                elif now - since >= self.settle:
+                    del self.candidates[filename]
+                    self.known.add(filename)
+                    ready.append(filename)
+            if ready:
+                yield sorted(ready)
+
+def parse_bandwidth_window(text):
+    """ parses a 'HH:MM-HH:MM=MB' daily window into (start minute, end minute, bytes/sec or None for unlimited) """
+    try:
+        span, rate = text.split('=')
+        times = [[int(field) for field in part.split(':')] for part in span.split('-')]
+        (start_hour, start_minute), (end_hour, end_minute) = times
+        rate = None if rate.strip() in ('max', 'unlimited') else float(rate) * 1e6
+    except (ValueError, IndexError):
+        raise argparse.ArgumentTypeError('expected HH:MM-HH:MM=MB (e.g. 08:00-18:00=2), got %r' % text)
+    if not all(0 <= hour <= 23 and 0 <= minute <= 59 for hour, minute in times):
+        raise argparse.ArgumentTypeError('hours must be 00-23 and minutes 00-59, got %r' % text)
+    if rate is not None and rate < 0:
+        raise argparse.ArgumentTypeError('the rate of a bandwidth window cannot be negative, got %r' % text)
+    return start_hour * 60 + start_minute, end_hour * 60 + end_minute, rate
+
+class RateLimiter(object):
+    """
+    spaces out uploads so that on average no more than `rate` bytes/sec are sent (None means unlimited).
+    `windows` are daily (start minute, end minute, rate) time-of-day windows that override the rate; a rate
+    of 0 pauses uploads until the window is over. `consume(nbytes)` blocks until nbytes may be sent.
+    """
+
+    def __init__(self, rate=None, windows=()):
+        self.rate = rate
+        self.windows = windows
+        self.lock = threading.Lock()
+        self.next_free = 0.0
+
+    def current_rate(self, now):
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, rate in self.windows:
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return rate
+        return self.rate
+
+    def consume(self, nbytes):
+        while True:
+            with self.lock:
+                now = time.time()
+                rate = self.current_rate(now)
+                if rate is None:
+                    return
+                if rate > 0:
+                    start = max(self.next_free, now)
+                    self.next_free = start + nbytes / rate
+                    break
+            logging.debug("uploads are paused by a bandwidth window")
+            time.sleep(30)
+        if start > now:
+            time.sleep(start - now)
+
+class UploadPool(object):
+    """
+    runs `upload(params)` over a stream of file params using a bounded number of worker threads,
+    with at most `per_camera` of them busy with the same camera at a time. failed uploads are retried
+    with exponential backoff. `on_done(params, success)` is always called from the thread that called
+    `run`, so it is safe to write to the storage db from there. with a `priority` key function, the
+    waiting file with the lowest key is uploaded next instead of the oldest one.
+    """
+
+    def __init__(self, upload, workers=1, per_camera=None, retries=0, backoff=1.0, priority=None):
+        self.upload = upload
+        self.priority = priority
+        self.workers = max(1, workers)
+        self.per_camera = max(1, per_camera or self.workers)
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.max_deferred = self.workers * 16
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+        self.in_flight = collections.defaultdict(int)
+
+    def attempt(self, params):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * 2 ** (attempt - 1)
+                logging.warn('retrying %s in %.1fs (attempt %i/%i)', params['filename'], delay, attempt + 1, self.retries + 1)
+                time.sleep(delay)
+            try:
+                if self.upload(params):
+                    return True
+            except:
+                logging.error('error while uploading %s', params['filename'])
+                logging.error(traceback.format_exc())
+        return False
+
+    def worker(self):
+        while True:
+            params = self.tasks.get()
+            if params is None:
+                return
+            self.results.put((params, self.attempt(params)))
+
+    def capped(self, params):
+        return self.in_flight[params['camera']] >= self.per_camera
+
+    def next_ready(self, deferred):
+        ready = (params for params in deferred if not self.capped(params))
+        if self.priority:
+            ready = list(ready)
+            return min(ready, key=self.priority) if ready else None
+        return next(ready, None)
+
+    def next_result(self):
+        # a timeout keeps the wait interruptible with ctrl-c
+        while True:
+            try:
+                return self.results.get(True, 3600)
+            except Queue.Empty:
+                pass
+
+    def run(self, items, on_done):
+        threads = [threading.Thread(target=self.worker) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        items = iter(items)
+        exhausted = False
+        deferred = collections.deque()
+        busy = 0
+        try:
+            while True:
+                while busy < self.workers:
+                    params = self.next_ready(deferred)
+                    if params is not None:
+                        deferred.remove(params)
+                    elif exhausted or len(deferred) >= self.max_deferred:
+                        break
+                    else:
+                        params = next(items, None)
+                        if params is None:
+                            exhausted = True
+                            break
+                        if self.capped(params):
+                            deferred.append(params)
+                            continue
+                    self.in_flight[params['camera']] += 1
+                    self.tasks.put(params)
+                    busy += 1
+                if not busy:
+                    break
+                # items may be produced slowly (e.g. by a folder walk), so keep pulling them while every worker is busy
+                if not exhausted and len(deferred) < self.max_deferred and self.results.empty():
+                    params = next(items, None)
+                    if params is None:
+                        exhausted = True
+                    else:
+                        deferred.append(params)
+                    continue
+                params, success = self.next_result()
+                busy -= 1
+                self.in_flight[params['camera']] -= 1
+                on_done(params, success)
+        finally:
+            for thread in threads:
+                self.tasks.put(None)
+
+class HookRunner(object):
+    """
+    calls the blocking hooks that are not uploads (register_camera, register_jobs) on up to `workers` threads,
+    so discovery and uploads carry on while the service answers. `done()` yields the (tag, result, error) of
+    finished calls and is only called from the importer's main thread.
+    """
+
+    def __init__(self, workers=4):
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+        self.pending = 0
+        self.threads = [threading.Thread(target=self.worker) for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def worker(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            tag, func, args, kwargs = task
+            try:
+                self.results.put((tag, func(*args, **kwargs), None))
+            except:
+                self.results.put((tag, None, traceback.format_exc()))
+
+    def submit(self, tag, func, *args, **kwargs):
+        self.pending += 1
+        self.tasks.put((tag, func, args, kwargs))
+
+    def done(self, wait=False):
+        """ yields the finished calls, first blocking until one finishes if `wait` """
+        while self.pending:
+            try:
+                # a timeout keeps the wait interruptible with ctrl-c
+                result = self.results.get(wait, 3600)
+            except Queue.Empty:
+                if wait:
+                    continue
+                return
+            self.pending -= 1
+            wait = False
+            yield result
+
+    def close(self):
+        for thread in self.threads:
+            self.tasks.put(None)
+
+def accepts_session(func):
+    """ whether a hook function takes the importer's pooled `session` keyword argument """
+    try:
+        spec = inspect.getargspec(func)
+    except TypeError:
+        return False
+    return 'session' in spec.args or spec.keywords is not None
+
 class GenericImporter(object):
 
     def __init__(self):
@@ -77,6 +960,9 @@ class GenericImporter(object):
         self.parser.add_argument('-v', '--verbose', action='store_true', default=False, help='set logging level to debug')
         self.parser.add_argument('-q', '--quiet', action='store_true', default=False, help='set logging level to errors only')
         self.parser.add_argument('-c', '--csv', action='store_true', default=False, help='dump csv log file')
+        self.parser.add_argument('--plan', action='store_true', default=False,
+                            help=('report per camera the files an import of the folders would upload, their size and time '
+                                  'range, and the file names --regex cannot parse, without reading or uploading any file'))
         self.parser.add_argument('-p', '--port', default=None, help='the segmenter port number (default: 8080)')
         self.parser.add_argument('--host', default=None, help='the IP address or hostname of the segmenter')
         self.parser.add_argument('--camera_name_suffix', default=None, 
@@ -86,26 +972,100 @@ class GenericImporter(object):
                 help=('regex to extract input-file metadata. The two capture group fields are <camera> and <epoch> '
                      'which capture the name of the camera that the video originates from and the timestamp of the start of '
                      'the video respectively. (default: "%s")' % self.DEFAULT_FILE_REGEX))
-        self.parser.add_argument('-s', '--storage', default='.processes.shelve',
-                            help='full path to the local storage db (default: ./.processes.shelve)')
+        self.parser.add_argument('-s', '--storage', default='.processes.sqlite',
+                            help=('full path to the local storage db (default: ./.processes.sqlite). records from a legacy '
+                                  'shelve store with the same name and a .shelve extension are migrated on first use. if the '
+                                  'path is a legacy shelve store itself, it is migrated into the same name with a .sqlite extension'))
         self.parser.add_argument('-d', '--hook_data_json', default=None,
                             help='a json object containing extra information to be passed to the hook-module')
         self.parser.add_argument('-f', '--hook_data_json_file', default=None,
                             help=('full path to a file containing a json object of extra info to be passed to the hook module.'
                             'note - the values passed in through the -d argument trump the values defined in the hook-data-json-file'))
+        self.parser.add_argument('-w', '--watch', action='store_true', default=False,
+                            help='keep running after the import and upload new videos as they land in the folder')
+        self.parser.add_argument('--watch_settle_time', type=float, default=30.0,
+                            help='seconds a new video must stop changing before it is imported in --watch mode (default: 30)')
+        self.parser.add_argument('--watch_interval', type=float, default=10.0,
+                            help='seconds between checks for new videos in --watch mode (default: 10)')
+        self.parser.add_argument('--watch_poll', action='store_true', default=False,
+                            help=('look for new videos by re-walking the folder instead of using inotify '
+                                  '(needed for network mounts; used anyway if pyinotify is not installed)'))
+        self.parser.add_argument('--progress_interval', type=float, default=30.0,
+                            help='seconds between progress reports (bytes/sec and eta) in the log, 0 disables them (default: 30)')
+        self.parser.add_argument('--metrics_file', default=None,
+                            help=('append progress reports and the time spent in every stage and hook call of the run '
+                                  'to this file, as json lines'))
+        self.parser.add_argument('--profile', default=None,
+                            help='profile the run with cProfile and write the stats to this file')
+        self.parser.add_argument('--rehash', action='store_true', default=False,
+                            help=('ignore the file index kept in the storage db and re-hash every file, '
+                                  'e.g. to re-verify files that were modified without changing their size or mtime'))
+        self.parser.add_argument('--fingerprint', choices=['full', 'sampled'], default='full',
+                            help=('how videos are keyed: "full" hashes every byte, "sampled" only hashes the size and '
+                                  'blocks from the head, middle and tail of large files (default: full)'))
+        self.parser.add_argument('--verify_fingerprints', action='store_true', default=False,
+                            help=('with --fingerprint sampled, compute the full hash of sampled files in the background '
+                                  'and record it in the storage db'))
+        self.parser.add_argument('--discovery_workers', type=int, default=multiprocessing.cpu_count(),
+                            help=('number of processes used to hash and probe videos while the folder is walked, '
+                                  '1 disables the process pool (default: number of cpus, %i)' % multiprocessing.cpu_count()))
+        self.parser.add_argument('--device_readers', type=int, default=1,
+                            help=('max number of files hashed at once from the same drive, to avoid seek thrashing on '
+                                  'spinning disks. raise it for SSDs (default: 1)'))
+        self.parser.add_argument('--upload_workers', type=int, default=1,
+                            help='number of videos to upload concurrently (default: 1)')
+        self.parser.add_argument('--camera_upload_limit', type=int, default=None,
+                            help='max number of concurrent uploads from the same camera (default: --upload_workers)')
+        self.parser.add_argument('--chunk_size', type=float, default=0,
+                            help=('upload videos in resumable chunks of this many MB through the hook-module\'s '
+                                  'post_video_chunk function, 0 posts whole files (default: 0)'))
+        self.parser.add_argument('--job_batch_size', type=int, default=0,
+                            help=('number of discovered files handed to the assign_job_ids hook at a time, so uploads start '
+                                  'while the folder is still being walked. every batch may get its own job id. 0 waits for the '
+                                  'whole folder and makes a single batch, one job per run (default: 0)'))
+        self.parser.add_argument('--camera_cache_ttl', type=float, default=24 * 3600,
+                            help=('seconds for which a camera registration is cached in the storage db and reused instead '
+                                  'of registering the camera again, 0 disables the cache (default: 86400)'))
+        self.parser.add_argument('--refresh_cameras', action='store_true', default=False,
+                            help='ignore cached camera registrations and register every camera again')
+        self.parser.add_argument('--camera_settle_time', type=float, default=1.0,
+                            help='seconds to wait after registering new cameras before uploading their videos (default: 1.0)')
+        self.parser.add_argument('--max_upload_rate', type=float, default=None,
+                            help=('cap on the upload rate to the service in MB/s, shared by all upload workers. without '
+                                  '--chunk_size whole files are paced, with it every chunk is (default: no cap)'))
+        self.parser.add_argument('--bandwidth_window', type=parse_bandwidth_window, action='append', default=None,
+                            help=('daily time-of-day window with its own upload rate in MB/s, as HH:MM-HH:MM=MB, e.g. '
+                                  '08:00-18:00=1 or 18:00-08:00=max. 0 pauses uploads during the window. may be repeated'))
+        self.parser.add_argument('--upload_order', choices=['walk', 'newest', 'oldest', 'smallest', 'largest'], default='walk',
+                            help=('order in which the files of a batch (see --job_batch_size) are uploaded: the order they '
+                                  'were discovered in, by video timestamp or by file size (default: walk)'))
+        self.parser.add_argument('--priority_cameras', type=lambda text: text.split(','), default=None,
+                            help='comma separated camera names whose videos are uploaded before all others, in that order')
+        self.parser.add_argument('--hook_workers', type=int, default=4,
+                            help=('number of register_camera and register_jobs hook calls that may run in the background '
+                                  'at once, while discovery and uploads carry on (default: 4)'))
+        self.parser.add_argument('--upload_retries', type=int, default=3,
+                            help='number of times a failed upload is retried before giving up on the file (default: 3)')
+        self.parser.add_argument('--retry_backoff', type=float, default=2.0,
+                            help='seconds to wait before the first retry, doubled on every further retry (default: 2.0)')
 
         # required, postitional arguments
-        self.parser.add_argument('folder', help='full path to folder of input videos to process')
+        self.parser.add_argument('folder', nargs='+',
+                            help='full path to folder of input videos to process (several folders, e.g. one per drive, may be given)')
         self.parser.add_argument('hook_module', help='full path to hook module for custom functions (a python file)')
         self.define_custom_args()
     
 
-    def init_args(self):
-        self.args = self.parser.parse_args()
+    def init_args(self, args=None):
+        self.args = self.parser.parse_args(args)
         if self.args.verbose:
             logging.getLogger().setLevel(logging.DEBUG)
         elif self.args.quiet:
             logging.getLogger().setLevel(logging.ERROR)
+        if not self.args.csv:
+            for folder in self.args.folder:
+                if not os.path.isdir(folder):
+                    self.parser.error('folder not found: %s' % folder)
         logging.info("submitted hooks module: %r", self.args.hook_module)
         self.module = imp.load_source('hooks_module', self.args.hook_module)
         # ensure all required callback functions exist
@@ -114,6 +1074,7 @@ class GenericImporter(object):
                 logging.error("hooks-module (%s) is missing required function: %s", self.args.hook_module, hook_callback)
                 logging.error("see README.md for information on required hook callback functions")
                 sys.exit(1)
+        self.hook_data = {}
         if hasattr(self.module, 'set_hook_data'):
             hook_data = dict(logger=logging.getLogger())
             if self.args.hook_data_json_file:
@@ -124,24 +1085,32 @@ class GenericImporter(object):
                     logging.error("error while loading json data from file: %s", self.args.hook_data_json_file)
                     logging.error("traceback:\n%r", traceback.format_exc())
                     sys.exit(1)
-                hook_data.update(data)
+                self.hook_data.update(data)
             if self.args.hook_data_json:
-                hook_data.update(json.loads(self.args.hook_data_json))
+                self.hook_data.update(json.loads(self.args.hook_data_json))
+            hook_data.update(self.hook_data)
             self.module.set_hook_data(hook_data)
+        self.chunked = self.args.chunk_size > 0 and hasattr(self.module, 'post_video_chunk')
+        if self.args.chunk_size > 0 and not self.chunked:
+            logging.warn("hooks-module (%s) has no post_video_chunk function, uploading whole files", self.args.hook_module)
+        # one pooled session shared by all upload workers and hook calls
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(1, self.args.upload_workers + self.args.hook_workers))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     
-    def get_params(self, path):
+    def parse_filename(self, path):
+        """ returns the (camera, epoch, lat, lng) that --regex parses from a path, None for the parts it does not find """
         camera_name = epoch = lat = lng = None
         if self.regex:
             match = self.regex.match(path)
             if match:
                 try:
                     camera_name = match.group('camera')
-                    logging.info('camera_name: %s', camera_name)
                 except: pass
                 try:
                     epoch = int(match.group('epoch'))
-                    logging.info('epoch: %s', epoch)
                 except: pass
                 try:
                     lat = float(match.group('lat'))                    
@@ -149,6 +1118,14 @@ class GenericImporter(object):
                 try:
                     lng = float(match.group('lng'))
                 except: pass
+        return camera_name, epoch, lat, lng
+
+    def get_params(self, path):
+        camera_name, epoch, lat, lng = self.parse_filename(path)
+        if camera_name:
+            logging.info('camera_name: %s', camera_name)
+        if epoch:
+            logging.info('epoch: %s', epoch)
         if not camera_name:
             # hard fail on no camera name, something went wrong
             logging.error('unable to parse camera name from file: %s using regex: "%s."', path, self.args.regex)
@@ -167,12 +1144,53 @@ class GenericImporter(object):
         return datetime.datetime.now().isoformat()
 
     def folder_walker(self, path, extensions=['.mp4']):
-        for root, subpaths, filenames in os.walk(path):
+        for root, subpaths, filenames in walk_tree(path):
             for filename in filenames:
                 if any(filename.endswith(ext) for ext in extensions):
                     fullpath = os.path.join(root,filename)
                     yield fullpath
 
+    def unique_roots(self, path):
+        """ returns the folders of `path` (one or a list), without repeats and folders nested in another one """
+        roots = [path] if isinstance(path, basestring) else path
+        unique = []
+        for root in sorted(roots, key=lambda root: len(os.path.realpath(root))):
+            real = os.path.realpath(root)
+            if not any(real == other or real.startswith(os.path.join(other, '')) for other in map(os.path.realpath, unique)):
+                unique.append(root)
+        return sorted(unique, key=roots.index)
+
+    def walk_roots(self, roots):
+        """
+        walks the roots with one thread per underlying device, so that several drives are walked at once
+        but each drive by a single reader, and yields the files of all of them as they are found
+        """
+        devices = collections.OrderedDict()
+        for root in self.unique_roots(roots):
+            devices.setdefault(os.stat(root).st_dev, []).append(root)
+        found = Queue.Queue(maxsize=1000)
+        def walk(roots):
+            try:
+                for root in roots:
+                    for filename in self.folder_walker(root):
+                        found.put(filename)
+            finally:
+                found.put(None)
+        for device_roots in devices.values():
+            thread = threading.Thread(target=walk, args=(device_roots,))
+            thread.daemon = True
+            thread.start()
+        walking = len(devices)
+        while walking:
+            try:
+                filename = found.get(True, 3600)
+            except Queue.Empty:
+                continue
+            if filename is None:
+                walking -= 1
+            else:
+                yield filename
+
     def lock_or_exit(self, lock_filename, message="process %s is already running"):
         pid = psutil.Process().pid
         if os.path.exists(lock_filename):
@@ -185,42 +1203,234 @@ class GenericImporter(object):
                     os.unlink(lock_filename)
 
     def hashfile(self, filename):
-        hasher = hashlib.sha1()
-        with open(filename, 'rb') as myfile:
-            for chunk in iter(lambda: myfile.read(4096), ''):
-                hasher.update(chunk)
-            return hasher.hexdigest()
+        return hash_file(filename)
+
+    def start_discovery_pool(self):
+        workers = self.args.discovery_workers
+        self.discovery_pool = multiprocessing.Pool(workers, initializer=ignore_sigint) if workers > 1 else None
+
+    def stop_discovery_pool(self, terminate=False):
+        if self.discovery_pool:
+            if terminate:
+                self.discovery_pool.terminate()
+            else:
+                self.discovery_pool.close()
+            self.discovery_pool.join()
+            self.discovery_pool = None
+
+    def stat_key(self, filename, st):
+        return '%s:%i:%r:%i' % (os.path.abspath(filename), st.st_size, st.st_mtime, st.st_ino)
+
+    def lookup_fingerprint(self, stat_key):
+        """ returns (key, complete) from the file index, complete meaning the key is a full content hash """
+        key = self.db.get_fingerprint(stat_key)
+        if key:
+            return key, True
+        if self.args.fingerprint == 'sampled':
+            return self.db.get_sample(stat_key), False
+        return None, False
+
+    def hash_files(self, filenames):
+        """
+        yields (filename, key, complete) for each of the filenames. files whose path, size, mtime and inode
+        match an entry in the file index are not read at all; the rest are fingerprinted (in the discovery pool
+        if there is one, concurrently with the walk) and added to the index. at most --device_readers files
+        of the same device are read at a time. results come back in completion order.
+        """
+        hashed = Queue.Queue()
+        pending = {}
+        waiting = collections.defaultdict(collections.deque)
+        reading = collections.defaultdict(int)
+        def dispatch():
+            for device, filenames in waiting.items():
+                while filenames and reading[device] < self.args.device_readers:
+                    task = (hash_task, ((filenames.popleft(), self.args.fingerprint),))
+                    self.discovery_pool.apply_async(timed_task, (task,), callback=hashed.put)
+                    reading[device] += 1
+
+        def record(filename, key, complete, error, seconds):
+            stat_key, size, device = pending.pop(filename)
+            self.metrics.add('hash', seconds, size)
+            if error:
+                logging.error('unable to read %s (%s), skipping this file', filename, error)
+                return None
+            if complete:
+                self.db.set_fingerprint(stat_key, key)
+                sampled_key = self.db.get_sample(stat_key)
+                if sampled_key and sampled_key != key and key not in self.db:
+                    # the file was keyed by a --fingerprint sampled run, its record is found through the alias
+                    self.db.add_alias(key, sampled_key)
+            else:
+                self.db.set_sample(stat_key, key)
+                if self.verifier:
+                    self.verifier.add(filename, key, stat_key)
+            return filename, key, complete
+
+        def drain(wait=False, keep=0):
+            while len(pending) > keep:
+                try:
+                    (filename, key, complete, error), seconds = hashed.get(wait, 3600)
+                except Queue.Empty:
+                    if not wait:
+                        return
+                    continue
+                reading[pending[filename][2]] -= 1
+                dispatch()
+                result = record(filename, key, complete, error, seconds)
+                if result:
+                    yield result
+
+        for filename in self.metrics.iterate('walk', filenames):
+            if filename in pending:
+                continue  # already being hashed
+            try:
+                st = os.stat(filename)
+            except OSError as e:
+                logging.error('unable to read %s (%s), skipping this file', filename, e)
+                continue
+            stat_key = self.stat_key(filename, st)
+            key, complete = (None, False) if self.args.rehash else self.lookup_fingerprint(stat_key)
+            if key:
+                yield filename, key, complete
+                continue
+            pending[filename] = (stat_key, st.st_size, st.st_dev)
+            if not self.discovery_pool:
+                (filename, key, complete, error), seconds = timed_task((hash_task, ((filename, self.args.fingerprint),)))
+                result = record(filename, key, complete, error, seconds)
+                if result:
+                    yield result
+            else:
+                waiting[st.st_dev].append(filename)
+                dispatch()
+                # keep the walk only a little ahead of the hashing
+                for result in drain(wait=True, keep=4 * self.args.discovery_workers):
+                    yield result
+            for result in drain():
+                yield result
+        for result in drain(wait=True):
+            yield result
+
+    def recognize_sampled(self, filename, key):
+        """
+        a sampled key that is not in the storage db may still belong to a file uploaded under its full hash (a record
+        migrated from shelve, or written before the file index existed). if an uploaded record has the same path and
+        size, the file is hashed in full after all and indexed under its full hash, so it is only uploaded if it differs.
+        """
+        st = os.stat(filename)
+        if not any(params.get('size', st.st_size) == st.st_size for _, params in
+                   self.db.iteritems('filename=? AND uploaded_on IS NOT NULL', (filename,))):
+            return key, False
+        logging.info('%s may have been uploaded under its full hash, hashing it in full', filename)
+        try:
+            with self.metrics.timer('hash', st.st_size):
+                full_key = hash_file(filename)
+        except EnvironmentError as e:
+            logging.error('unable to read %s (%s)', filename, e)
+            return key, False
+        self.db.set_fingerprint(self.stat_key(filename, st), full_key)
+        return self.db.resolve(full_key), True
+
+    def probe_duration(self, params):
+        duration = self.db.get_duration(params['key'])
+        if duration is not None:
+            # same content as a file probed before
+            self.probed.put((params, (duration, 0.0)))
+            self.probes_pending += 1
+            return
+        task = (get_duration, (params['filename'],))
+        if not self.discovery_pool:
+            self.probed.put((params, timed_task(task)))
+        else:
+            def callback(result):
+                self.probed.put((params, result))
+            self.discovery_pool.apply_async(timed_task, (task,), callback=callback)
+        self.probes_pending += 1
+
+    def collect_probes(self, wait=False):
+        """ records the durations of probed files and yields their params """
+        while self.probes_pending:
+            try:
+                params, (duration, seconds) = self.probed.get(wait, 3600)
+            except Queue.Empty:
+                if not wait:
+                    return
+                continue
+            self.probes_pending -= 1
+            self.metrics.add('probe', seconds, params['size'])
+            if duration is not None:
+                self.db.set_duration(params['key'], duration)
+            params['duration'] = duration or 0
+            self.db[params['key']] = params
+            self.db.sync()
+            yield params
 
     def upload_filename(self, filename, url, headers=None): 
         headers = headers or {}  
         with open(filename, 'rb') as myfile:
             try:
-                res = requests.post(url, headers=headers, data=myfile)
-                return res.response_status == 200
+                res = self.session.post(url, headers=headers, data=myfile)
+                return res.status_code == 200
             except:
                 logging.error('connection refused')
                 return False
 
-    def upload_folder(self, path):
-        self.regex = self.args.regex and re.compile(self.args.regex)
-        shelve_name = os.path.join(os.path.dirname(__file__), self.args.storage)
-        shelve_name_lock = shelve_name + '.lock'
-        self.lock_or_exit(shelve_name_lock)
-        db = shelve.open(shelve_name)
-        self.cameras = {}
-        unprocessed = []
-        unscheduled = []
-        scheduled = set()
+    def storage_names(self):
+        """
+        returns (sqlite store, legacy shelve store) for --storage. if --storage names a legacy shelve store
+        (e.g. the old default .processes.shelve, given explicitly) it is migrated into a sibling .sqlite store
+        """
+        storage_name = os.path.join(os.path.dirname(__file__), self.args.storage)
+        if whichdb.whichdb(storage_name):
+            return os.path.splitext(storage_name)[0] + '.sqlite', storage_name
+        return storage_name, os.path.splitext(storage_name)[0] + '.shelve'
+
+    def open_storage(self, readonly=False):
+        storage_name, legacy_name = self.storage_names()
+        if readonly:
+            # without taking the lock, so the db on disk is left as it is: a store still to be migrated
+            # (or none at all) is read into memory instead
+            if os.path.exists(storage_name):
+                db = StateStore(storage_name, readonly=True)
+                if db.get_meta('migrated_from') or not whichdb.whichdb(legacy_name):
+                    return db
+                db.close()
+            db = StateStore(':memory:')
+            if whichdb.whichdb(legacy_name):
+                db.migrate_shelve(legacy_name)
+            return db
+        db = StateStore(storage_name)
+        if not db.get_meta('migrated_from') and whichdb.whichdb(legacy_name):
+            logging.info("migrating legacy storage %s into %s", legacy_name, storage_name)
+            db.migrate_shelve(legacy_name)
+        return db
+
+    def discover(self, filenames):
+        """
+        yields the params of every file among filenames that still needs to be uploaded, as soon as its record
+        in the storage db is complete. duplicates and files that were already uploaded are skipped.
+        """
+        db = self.db
         discovered_on = self.now()
-        found_new = False
-        job_id = None
-        for filename in self.folder_walker(path):        
-            params = self.get_params(filename)
+        scheduled = set()
+        self.probed = Queue.Queue()
+        self.probes_pending = 0
+        parsed = {}
+        def parse(filenames):
+            # names are parsed before their file is hashed, so a bad --regex fails fast
+            for filename in filenames:
+                parsed[filename] = self.get_params(filename)
+                yield filename
+        for filename, key, complete in self.hash_files(parse(filenames)):
+            for params in self.collect_probes():
+                yield params
+            key = db.resolve(key)
+            if not complete and key not in db:
+                key, complete = self.recognize_sampled(filename, key)
+            params = parsed.pop(filename, None) or self.get_params(filename)
             if not params:
                 logging.error(
                         "error while parsing metadata from file: %s, skipping this file", filename)
                 continue
-            key = self.hashfile(filename)
             given_name = params['camera']+'.'+params['timestamp']+'.'+key+'.mp4'
             if key in scheduled:
                 logging.info('%s (duplicate)' % filename)
@@ -228,102 +1438,425 @@ class GenericImporter(object):
                 logging.info('%s (uploaded)' % filename)
             else:
                 logging.info('%s (scheduled for upload)' % filename)
-                found_new = True # if we reach this point we found a new file
-                self.cameras[params['camera']] = None
                 scheduled.add(key)
                 if key in db:
-                    params = db[key]
-                else:
-                    params['filename'] = filename
-                    params['duration'] = get_duration(filename) or 0
-                    params['key'] = key
-                    params['given_name'] = given_name
-                    params['discovered_on'] = discovered_on
-                    params['uploaded_on'] = None
-                    params['confirmed_on'] = None
-                    params['job_id'] = None
-                    params['shard_id'] = None
-                    params['size'] = os.path.getsize(params['filename'])
-                    db[key] = params
-                    db.sync()
-                unprocessed.append(params)
-                if not params.get('job_id'):
-                    unscheduled.append(params)
-
-        if not found_new:
-            logging.info("no new files found for uploading in directory: %s", path)
-            logging.info("if you wish to rerun the import on these files, delete the storage file at: %s", self.args.storage)
-            sys.exit(0)
+                    yield db[key]
+                    continue
+                params['filename'] = filename
+                params['duration'] = 0
+                params['key'] = key
+                params['fingerprint'] = 'full' if complete else 'sampled'
+                params['given_name'] = given_name
+                params['discovered_on'] = discovered_on
+                params['uploaded_on'] = None
+                params['confirmed_on'] = None
+                params['job_id'] = None
+                params['shard_id'] = None
+                params['size'] = os.path.getsize(params['filename'])
+                self.probe_duration(params)
+        for params in self.collect_probes(wait=True):
+            yield params
 
-        for camera_name in self.cameras:
-            camera_config = self.register_camera(camera_name)
-            camera_id = camera_config.get('camera_id')
-            if not camera_id:
-                logging.error("unable to properly register camera with service (no unique camera ID returned)")
-                #@TODO - what to do here? Keep going on a best-effort basis, fail fast and early?
-            logging.debug("Camera ID: %r", camera_id)
-            self.cameras[camera_name] = camera_config
+    def add_camera(self, camera_name):
+        """
+        returns True if the camera is known (or its registration is cached), otherwise hands its registration
+        to the hook runner; camera_registered is called once the service has answered.
+        """
+        camera_config = None
+        if self.args.camera_cache_ttl > 0 and not self.args.refresh_cameras:
+            camera_config = self.db.get_camera(camera_name, self.service, self.args.camera_cache_ttl)
+        if camera_config:
+            logging.debug("using cached registration of camera %s", camera_name)
+            self.set_camera(camera_name, camera_config)
+            return True
+        self.hooks.submit(('register_camera', camera_name), self.register_camera, camera_name)
+        return False
 
+    def camera_registered(self, camera_name, camera_config):
+        camera_id = camera_config.get('camera_id')
+        if not camera_id:
+            logging.error("unable to properly register camera with service (no unique camera ID returned)")
+            #@TODO - what to do here? Keep going on a best-effort basis, fail fast and early?
+        else:
+            self.db.set_camera(camera_name, self.service, camera_config)
+            self.db.commit()
+        logging.debug("Camera ID: %r", camera_id)
+        self.cameras_registered = True
+        self.set_camera(camera_name, camera_config)
+
+    def set_camera(self, camera_name, camera_config):
+        self.cameras[camera_name] = camera_config
         if hasattr(self.module, 'set_hook_data'):
-            # now we know all of the camera configuration data, give it to the hook module in case they need it
+            # now we know the camera configuration data, give it to the hook module in case they need it
             logging.debug("setting camera config data in hook module for cameras: %r", [name for name in self.cameras])
-            self.module.set_hook_data(dict(registered_cameras=[self.cameras[name] for name in self.cameras]))
+            with self.metrics.timer('hook:set_hook_data'):
+                self.module.set_hook_data(dict(registered_cameras=[self.cameras[name] for name in self.cameras]))
+
+    def schedule(self, discovered):
+        """
+        registers each camera the first time one of its files is discovered and passes the discovered files
+        to the assign_job_ids hook in batches of --job_batch_size, yielding every batch for upload as soon as
+        its job ids are assigned.
+        """
+        batch = []
+        for params in self.with_cameras(discovered):
+            batch.append(params)
+            if len(batch) == self.args.job_batch_size:
+                for params in self.flush_batch(batch):
+                    yield params
+                batch = []
+        if batch:
+            for params in self.flush_batch(batch):
+                yield params
+
+    def with_cameras(self, discovered):
+        """
+        yields the discovered files once their camera is registered. new cameras are registered in the
+        background, holding back only the files of those cameras meanwhile.
+        """
+        for params in discovered:
+            for ready in self.collect_hooks():
+                yield ready
+            camera_name = params['camera']
+            if camera_name in self.cameras:
+                yield params
+            elif camera_name in self.waiting:
+                self.waiting[camera_name].append(params)
+            elif self.add_camera(camera_name):
+                yield params
+            else:
+                self.waiting[camera_name] = [params]
+        while self.waiting:
+            for ready in self.collect_hooks(wait=True):
+                yield ready
 
-        # let the camera registration info prop. to Box and let Box kick off the webserver
-        time.sleep(1)
+    def collect_hooks(self, wait=False):
+        """ handles the finished background hook calls, yielding the files of newly registered cameras """
+        for (hook, arg), result, error in self.hooks.done(wait):
+            if hook == 'register_camera':
+                if error:
+                    logging.error("error while registering camera %s", arg)
+                    logging.error(error)
+                    sys.exit(1)
+                self.camera_registered(arg, result or {})
+                for params in self.waiting.pop(arg):
+                    yield params
+            elif error or not result:
+                # their journal entries are kept, so the next run registers them again
+                logging.error("not able to register jobs, retrying on the next run")
+                if error:
+                    logging.error(error)
+
+    def flush_batch(self, batch):
+        if self.cameras_registered:
+            # let the camera registration info prop. to Box and let Box kick off the webserver
+            time.sleep(self.args.camera_settle_time)
+            self.cameras_registered = False
         if hasattr(self.module, 'assign_job_ids'):
-            job_id = self.assign_job_ids(db, unscheduled)
-            if not job_id:
+            unscheduled = [params for params in batch if not params.get('job_id')]
+            job_id = self.assign_job_ids(self.db, unscheduled)
+            if job_id:
+                logging.info("Job ID %s assigned to %i files", job_id, len(unscheduled))
+                self.job_id = job_id
+            else:
                 logging.warn("no job_id returned from 'assign_job_id' hook function")
+        self.db.commit()
+        # register_jobs is called once all the files of the batch are done
+        tracking = {'pending': len(batch), 'jobs': set(), 'keys': []}
+        for params in batch:
+            self.batches[params['key']] = tracking
+            self.metrics.scheduled(params)
+        self.scheduled_count += len(batch)
+        if self.args.upload_order != 'walk' or self.args.priority_cameras:
+            batch.sort(key=self.upload_priority)
+        return batch
 
-        total_count = len(unprocessed)
-        jobs = set()
-        for k, params in enumerate(unprocessed):
-            logging.info('%i/%i uploading %s' % (k+1, total_count, params['filename']))
-            if self.args.verbose:
-                logging.info('input-file %s has been renamed %s', params['filename'], given_name)
-            latlng = (params['lat'], params['lng'])
-            logging.debug("Params: %r", params)
-            success = self.post_video(params['camera'], params['timestamp'], params['filename'], latlng)
-            if success:
-                logging.info('completed')
-            else:
-                logging.error('unable to post')
-                break
+    def upload_priority(self, params):
+        """ sort key of a file under --upload_order and --priority_cameras, lowest is uploaded first """
+        key = []
+        if self.args.priority_cameras:
+            cameras = self.args.priority_cameras
+            key.append(cameras.index(params['camera']) if params['camera'] in cameras else len(cameras))
+        order = self.args.upload_order
+        if order in ('newest', 'oldest'):
+            epoch = time.mktime(datetime.datetime.strptime(params['timestamp'][:19], '%Y-%m-%dT%H:%M:%S').timetuple())
+            key.append(-epoch if order == 'newest' else epoch)
+        elif order in ('smallest', 'largest'):
+            key.append(params['size'] if order == 'smallest' else -params['size'])
+        return key
+
+    def upload_done(self, params, success):
+        logging.info('%i/%i %s %s', next(self.done_counter), self.scheduled_count,
+                     'completed' if success else 'failed', params['filename'])
+        self.metrics.uploaded(params, success)
+        batch = self.batches.pop(params['key'])
+        batch['pending'] -= 1
+        if success:
             params['uploaded_on'] = self.now()
-            jobs.add((params['job_id'], params['shard_id']))
-            db[params['key']] = params
-            db.sync()
+            batch['jobs'].add((params['job_id'], params['shard_id']))
+            batch['keys'].append(params['key'])
+            self.db.clear_chunks(params['key'])
+            self.db[params['key']] = params
+            self.journal_uploaded(params)
+        else:
+            logging.error('unable to post %s', params['filename'])
+            self.failed.append(params)
+            self.db.clear_journal([params['key']])
+            self.db.sync()
+        if not batch['pending'] and hasattr(self.module, 'register_jobs'):
+            self.hooks.submit(('register_jobs', None), self.register_batch_jobs, batch['keys'], batch['jobs'])
 
+    def register_batch_jobs(self, keys, jobs):
+        ret = self.register_jobs(self.db, jobs)
+        if ret:
+            # cleared as soon as the service has the jobs, a crash after this point does not register them again
+            self.db.clear_journal(keys)
+            self.db.commit()
+        return ret
+
+    def journal_uploaded(self, params):
+        """ commits the record of an uploaded file together with its journal entry """
         if hasattr(self.module, 'register_jobs'):
-            ret = self.register_jobs(db, jobs)
-            if not ret:
-                logging.error("not able to register jobs")
-        db.close()
-        return job_id
-
-    def list_files(self, path):
-        storage = self.args.storage
-        shelve_name = os.path.join(os.path.dirname(__file__), storage)
-        db = shelve.open(shelve_name)
-        status = []
-        for key, value in db.items():
-            value['hash'] = key
-            status.append(value)
-            status.sort(lambda a,b: cmp(a['filename'],b['filename']))
-        stream = StringIO.StringIO()
+            # kept until its jobs are registered, so a crash before that does not lose them
+            self.db.journal_file(params['key'], 'uploaded', params)
+        else:
+            self.db.clear_journal([params['key']])
+            self.db.commit()
+
+    def reconcile_journal(self):
+        """
+        settles the files an interrupted run left in the journal: uploads that were under way are recorded as
+        uploaded if the hook-module's check_video_uploaded says the service has them (otherwise they are simply
+        uploaded again, resuming from their last acknowledged chunk), and the jobs of uploaded files are registered.
+        """
+        for params in self.db.journaled('uploading'):
+            if self.check_video_uploaded(params):
+                logging.info('%s was uploaded by an interrupted run', params['filename'])
+                params['uploaded_on'] = self.now()
+                self.db.clear_chunks(params['key'])
+                self.db[params['key']] = params
+                self.journal_uploaded(params)
+            else:
+                self.db.clear_journal([params['key']])
+        uploaded = self.db.journaled('uploaded')
+        if uploaded and hasattr(self.module, 'register_jobs'):
+            logging.info('registering the jobs of %i files uploaded by an interrupted run', len(uploaded))
+            jobs = set((params['job_id'], params['shard_id']) for params in uploaded)
+            if not self.register_batch_jobs([params['key'] for params in uploaded], jobs):
+                logging.error("not able to register jobs, retrying on the next run")
+        elif uploaded:
+            self.db.clear_journal([params['key'] for params in uploaded])
+        self.db.commit()
+
+    def start_import(self):
+        self.regex = self.args.regex and re.compile(self.args.regex)
+        storage_name, legacy_name = self.storage_names()
+        self.lock_or_exit(storage_name + '.lock')
+        self.metrics = Metrics(self.args.metrics_file, self.args.progress_interval)
+        self.db = self.open_storage()
+        self.db.metrics = self.metrics
+        # camera registrations are cached per service, and per hook-module and hook data (which may hold the
+        # service's address and account) as --host and --port are often not given
+        self.service = '%s:%s/%s/%s' % (self.args.host, self.args.port, os.path.realpath(self.args.hook_module),
+                                        hashlib.sha1(json.dumps(self.hook_data, sort_keys=True)).hexdigest())
+        self.cameras = {}
+        self.waiting = {}
+        self.hooks = HookRunner(self.args.hook_workers)
+        self.cameras_registered = False
+        self.reconcile_journal()
+        self.batches = {}
+        self.scheduled_count = 0
+        self.done_counter = itertools.count(1)
+        self.failed = []
+        self.job_id = None
+        self.verifier = None
+        if self.args.fingerprint == 'sampled' and self.args.verify_fingerprints:
+            self.verifier = FingerprintVerifier(self.db)
+        prioritized = self.args.upload_order != 'walk' or self.args.priority_cameras
+        self.upload_pool = UploadPool(self.upload_video, workers=self.args.upload_workers,
+                per_camera=self.args.camera_upload_limit, retries=self.args.upload_retries,
+                backoff=self.args.retry_backoff, priority=self.upload_priority if prioritized else None)
+        max_rate = self.args.max_upload_rate * 1e6 if self.args.max_upload_rate else None
+        self.rate_limiter = RateLimiter(max_rate, self.args.bandwidth_window or ())
+        self.start_discovery_pool()
+
+    def import_files(self, filenames):
+        self.upload_pool.run(self.schedule(self.discover(filenames)), self.upload_done)
+
+    def finish_import(self, aborted=False):
+        self.stop_discovery_pool(terminate=aborted)
+        while self.hooks.pending and not aborted:
+            for params in self.collect_hooks(wait=True):
+                pass
+        self.hooks.close()
+        if self.verifier and not aborted:
+            logging.info("waiting for background fingerprint verification to finish")
+            self.verifier.finish()
+        self.db.close()
+        self.metrics.finish()
+
+    def upload_folder(self, path):
+        roots = self.unique_roots(path)
+        self.start_import()
+        try:
+            self.import_files(self.walk_roots(roots))
+        except BaseException:
+            self.finish_import(aborted=True)
+            raise
+        self.finish_import()
+
+        if not self.scheduled_count:
+            logging.info("no new files found for uploading in directory: %s", ', '.join(roots))
+            logging.info("if you wish to rerun the import on these files, delete the storage file at: %s", self.storage_names()[0])
+            sys.exit(0)
+        if self.failed:
+            logging.error('%i/%i files could not be uploaded, rerun the import to retry them',
+                          len(self.failed), self.scheduled_count)
+        return self.job_id
+
+    def watch_folder(self, path):
+        """
+        imports the folders like upload_folder, then keeps running and imports new files as they land,
+        with the hook-module and the camera registrations staying loaded between batches
+        """
+        roots = self.unique_roots(path)
+        watcher = FolderWatcher(roots, self.folder_walker, settle=self.args.watch_settle_time,
+                                interval=self.args.watch_interval, poll=self.args.watch_poll)
+        self.start_import()
+        try:
+            self.import_files(watcher.initial)
+            if watcher.candidates:
+                logging.info("%i files changed in the last %.0fs, importing them once they settle",
+                             len(watcher.candidates), self.args.watch_settle_time)
+            logging.info("watching %s for new files (ctrl-c to stop)", ', '.join(roots))
+            for filenames in watcher:
+                logging.info("%i new files in %s", len(filenames), ', '.join(roots))
+                self.import_files(filenames)
+        except KeyboardInterrupt:
+            logging.info("stopped watching %s", ', '.join(roots))
+            self.finish_import(aborted=True)
+            return self.job_id
+        except BaseException:
+            self.finish_import(aborted=True)
+            raise
+        self.finish_import()
+        return self.job_id
+
+    def list_files(self, path, stream=None):
+        stream = stream or StringIO.StringIO()
+        db = self.open_storage()
         writer = csv.writer(stream)
-        writer.writerow(('FILENAME','GIVEN_NAME','CREATED_ON','DISCOVERED_ON','UPLOADED_ON'))
-        for params in status:
+        writer.writerow(('FILENAME','GIVEN_NAME','CAMERA','CREATED_ON','DISCOVERED_ON','UPLOADED_ON'))
+        for key, params in db.iteritems(order_by='filename'):
             writer.writerow((params['filename'], params['given_name'],params['camera'],
                              params['timestamp'], params['discovered_on'], params['uploaded_on']))
-        return stream.getvalue()
+        db.close()
+        return stream
 
+    def plan_folder(self, path, stream=None):
+        """
+        reports what importing the folders would do, from the file names and the storage db alone: per camera the
+        number and size of the files, their time range and how many of them were uploaded already, and the files
+        whose names --regex cannot parse, which are returned. no file is read, hashed or uploaded.
+        """
+        roots = self.unique_roots(path)
+        stream = stream or sys.stdout
+        self.regex = self.args.regex and re.compile(self.args.regex)
+        self.db = self.open_storage(readonly=True)
+        cameras = {}
+        unparsable = []
+        no_epoch = 0
+        for filename in self.walk_roots(roots):
+            try:
+                st = os.stat(filename)
+            except OSError as e:
+                logging.warn('unable to read %s (%s), skipping this file', filename, e)
+                continue
+            camera_name, epoch, lat, lng = self.parse_filename(filename)
+            if not camera_name:
+                unparsable.append(filename)
+                continue
+            if not epoch:
+                epoch = st.st_ctime
+                no_epoch += 1
+            if self.args.camera_name_suffix:
+                camera_name = camera_name + self.args.camera_name_suffix
+            camera = cameras.setdefault(camera_name, dict(files=0, size=0, first=epoch, last=epoch, uploaded=0, uploaded_size=0))
+            camera['files'] += 1
+            camera['size'] += st.st_size
+            camera['first'] = min(camera['first'], epoch)
+            camera['last'] = max(camera['last'], epoch)
+            if self.was_uploaded(filename, st):
+                camera['uploaded'] += 1
+                camera['uploaded_size'] += st.st_size
+        self.db.close()
 
-    def run(self):
-        self.init_args()
+        def when(epoch):
+            return datetime.datetime.fromtimestamp(epoch).strftime('%Y-%m-%d %H:%M:%S')
+        total = dict(files=0, size=0, uploaded=0, uploaded_size=0)
+        stream.write('%-24s %7s %10s %9s %10s  %-19s  %-19s\n' % ('CAMERA', 'FILES', 'MB', 'UPLOADED', 'MB LEFT', 'FIRST', 'LAST'))
+        for camera_name in sorted(cameras):
+            camera = cameras[camera_name]
+            stream.write('%-24s %7i %10.1f %9i %10.1f  %-19s  %-19s\n' % (camera_name, camera['files'], camera['size'] / 1e6,
+                         camera['uploaded'], (camera['size'] - camera['uploaded_size']) / 1e6,
+                         when(camera['first']), when(camera['last'])))
+            for field in total:
+                total[field] += camera[field]
+        left = total['size'] - total['uploaded_size']
+        stream.write('%-24s %7i %10.1f %9i %10.1f\n' % ('TOTAL', total['files'], total['size'] / 1e6, total['uploaded'], left / 1e6))
+        stream.write('%i files (%.1f MB) left to upload' % (total['files'] - total['uploaded'], left / 1e6))
+        if self.args.max_upload_rate:
+            stream.write(', about %s at --max_upload_rate %g MB/s' % (
+                         datetime.timedelta(seconds=int(left / (self.args.max_upload_rate * 1e6))), self.args.max_upload_rate))
+        stream.write('\n')
+        if no_epoch:
+            stream.write('%i files have no epoch in their name, the time they were last changed would be used\n' % no_epoch)
+        if unparsable:
+            stream.write('%i files have no camera name that --regex "%s" can parse, the import would stop at the first one:\n'
+                         % (len(unparsable), self.args.regex))
+            for filename in unparsable:
+                stream.write('  %s\n' % filename)
+        return unparsable
+
+    def was_uploaded(self, filename, st):
+        """
+        whether an import would find the file uploaded already: by its entry in the file index, looked up like
+        hash_files does for --fingerprint, or else by an uploaded record with the same path and size (such files
+        are hashed by the import, which finds the record if their content is unchanged)
+        """
+        stat_key = self.stat_key(filename, st)
+        key, complete = self.lookup_fingerprint(stat_key)
+        if not key and self.args.fingerprint == 'full':
+            # hash_files records the full hash as an alias of the key of a sampled run
+            key = self.db.get_sample(stat_key)
+        if key:
+            params = self.db.get(self.db.resolve(key))
+            return bool(params and params['uploaded_on'])
+        for key, params in self.db.iteritems('filename=? AND uploaded_on IS NOT NULL', (filename,)):
+            if params.get('size', st.st_size) == st.st_size:
+                return True
+        return False
+
+    def run(self, args=None):
+        self.init_args(args)
+        if self.args.profile:
+            # only the importer's main thread is profiled: discovery, scheduling and storage writes
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(self.run_command)
+            finally:
+                profiler.dump_stats(self.args.profile)
+                logging.info("profile written to %s (read it with python -m pstats)", self.args.profile)
+        return self.run_command()
+
+    def run_command(self):
         if self.args.csv:
-            logging.info(self.list_files(self.args.folder))
+            self.list_files(self.args.folder, sys.stdout)
+        elif self.args.plan:
+            if self.plan_folder(self.args.folder, sys.stdout):
+                sys.exit(1)
+        elif self.args.watch:
+            return self.watch_folder(self.args.folder)
         else:
             return self.upload_folder(self.args.folder)
 
@@ -338,24 +1871,108 @@ class GenericImporter(object):
         
     def register_camera(self, camera_name):
         host, port = self.args.host, self.args.port
-        return self.module.register_camera(camera_name, host=host, port=port)
+        kwargs = dict(host=host, port=port)
+        if accepts_session(self.module.register_camera):
+            kwargs['session'] = self.session
+        with self.metrics.timer('hook:register_camera'):
+            return self.module.register_camera(camera_name, **kwargs)
 
     def assign_job_ids(self, db, unscheduled):
         logging.debug("assigning job id: %r", unscheduled)
         if 'assign_job_ids' in dir(self.module):
-            return self.module.assign_job_ids(self, db, unscheduled)
+            with self.metrics.timer('hook:assign_job_ids'):
+                return self.module.assign_job_ids(self, db, unscheduled)
         return
 
     def register_jobs(self, db, jobs):
         logging.debug("registering jobs: %r", jobs)
         if 'register_jobs' in dir(self.module):
-            return self.module.register_jobs(self, db, jobs)
+            with self.metrics.timer('hook:register_jobs'):
+                return self.module.register_jobs(self, db, jobs)
         return
 
+    def upload_video(self, params):
+        logging.info('uploading %s' % params['filename'])
+        self.db.journal_file(params['key'], 'uploading', params)
+        if self.args.verbose:
+            logging.info('input-file %s has been renamed %s', params['filename'], params['given_name'])
+        latlng = (params['lat'], params['lng'])
+        logging.debug("Params: %r", params)
+        started, success = time.time(), False
+        try:
+            if self.chunked:
+                success = self.post_video_chunks(params, latlng)
+            else:
+                # the hook-module reads the file itself, so the whole file is accounted for up front
+                self.throttle(params['size'])
+                success = self.post_video(params['camera'], params['timestamp'], params['filename'], latlng)
+        finally:
+            self.metrics.add('upload', time.time() - started, params['size'] if success else 0)
+        return success
+
+    def check_video_uploaded(self, params):
+        if not hasattr(self.module, 'check_video_uploaded'):
+            return False
+        host, port = self.args.host, self.args.port
+        camera_config = self.db.get_camera(params['camera'], self.service) or {}
+        kwargs = dict(host=host, port=port)
+        if accepts_session(self.module.check_video_uploaded):
+            kwargs['session'] = self.session
+        with self.metrics.timer('hook:check_video_uploaded'):
+            return self.module.check_video_uploaded(params['camera'], camera_config.get('camera_id'), params['filename'],
+                    params['timestamp'], params['key'], params['size'], **kwargs)
+
+    def throttle(self, nbytes):
+        with self.metrics.timer('throttle'):
+            self.rate_limiter.consume(nbytes)
+
+    def resume_offset(self, params, myfile):
+        last = self.db.last_chunk(params['key'])
+        if not last:
+            return 0
+        offset, length, checksum = last
+        myfile.seek(offset)
+        if hashlib.sha1(myfile.read(length)).hexdigest() != checksum:
+            logging.warn('%s changed since its last acknowledged chunk, restarting the upload', params['filename'])
+            self.db.clear_chunks(params['key'])
+            return 0
+        return offset + length
+
+    def post_video_chunks(self, params, location):
+        host, port = self.args.host, self.args.port
+        camera_id = self.cameras[params['camera']].get('camera_id')
+        filename, key = params['filename'], params['key']
+        chunk_size = max(1, int(self.args.chunk_size * 1024 * 1024))
+        total_size = os.path.getsize(filename)
+        with open(filename, 'rb') as myfile:
+            offset = self.resume_offset(params, myfile)
+            if offset:
+                logging.info('resuming %s at byte %i/%i', filename, offset, total_size)
+            myfile.seek(offset)
+            while True:
+                data = myfile.read(chunk_size)
+                if not data and offset:
+                    break
+                self.throttle(len(data))
+                with self.metrics.timer('hook:post_video_chunk', len(data)):
+                    success = self.module.post_video_chunk(params['camera'], camera_id, filename, params['timestamp'],
+                            key, offset, data, total_size, location=location, host=host, port=port, session=self.session)
+                if not success:
+                    return False
+                self.db.ack_chunk(key, offset, len(data), hashlib.sha1(data).hexdigest(), self.now())
+                offset += len(data)
+                if len(data) < chunk_size:
+                    break
+        return True
+
     def post_video(self, camera_name, timestamp, filepath, location):
         host, port = self.args.host, self.args.port
         camera_id = self.cameras[camera_name].get('camera_id')
-        return self.module.post_video_content(camera_name, camera_id, filepath, timestamp, location=location, host=host, port=port)
+        kwargs = dict(location=location, host=host, port=port)
+        if accepts_session(self.module.post_video_content):
+            kwargs['session'] = self.session
+        with self.metrics.timer('hook:post_video_content', os.path.getsize(filepath)):
+            return self.module.post_video_content(camera_name, camera_id, filepath, timestamp, **kwargs)
 
 def main():
     job_id = GenericImporter().run()